@@ -18,18 +18,63 @@ from agent.finetune.train_agent import TrainAgent
 from util.scheduler import CosineAnnealingWarmupRestarts
 
 
+def get_episodes_start_end(firsts_trajs):
+    """
+    Finds the completed episodes in a rollout with a single scan over all envs.
+
+    :param firsts_trajs: Episode start flags, shape (n_steps + 1, n_envs).
+    :return: A list of (env_ind, start, end) with inclusive end step, ordered by env then step.
+    """
+    # transpose so that nonzero returns flags sorted by env, then by step
+    env_inds, steps = np.nonzero(firsts_trajs.T == 1)
+    valid = (env_inds[1:] == env_inds[:-1]) & (steps[1:] - steps[:-1] > 1)
+    return list(
+        zip(
+            env_inds[:-1][valid].tolist(),
+            steps[:-1][valid].tolist(),
+            (steps[1:][valid] - 1).tolist(),
+        )
+    )
+
+
+def rwr_weights(returns, beta, max_weight):
+    """
+    Normalizes returns and maps them to clamped exponential weights. Written as one expression so torch.compile can fuse it into a single elementwise kernel.
+
+    :param returns: Discounted returns, shape (N,).
+    :param beta: Reward exponential temperature.
+    :param max_weight: Upper bound of the weights.
+    :return: The reward weights, shape (N,).
+    """
+    return torch.clamp(
+        torch.exp(
+            beta * (returns - returns.mean()) / (returns.std(unbiased=False) + 1e-3)
+        ),
+        max=max_weight,
+    )
+
+
 class TrainRWRDiffusionAgent(TrainAgent):
     def __init__(self, cfg):
         super().__init__(cfg)
 
         # note the discount factor gamma here is applied to reward every act_steps, instead of every env step
         self.gamma = cfg.train.gamma
-
-        # Build optimizer
+        self.gamma_pows = np.power(
+            self.gamma, np.arange(self.n_steps + 1), dtype=np.float64
+        )  # episodes are at most n_steps long within an iteration; float64 since returns divide by gamma^t
+        assert (
+            self.gamma_pows[-1] > np.finfo(np.float64).tiny
+        ), "gamma^n_steps underflows float64, returns computed by dividing by gamma^t would not be finite"
+
+        # Build optimizer - fused kernel on cuda, multi-tensor otherwise
+        self.on_cuda = "cuda" in str(self.device)
         self.optimizer = torch.optim.AdamW(
             self.model.parameters(),
             lr=cfg.train.lr,
             weight_decay=cfg.train.weight_decay,
+            fused=self.on_cuda,
+            foreach=not self.on_cuda,
         )
         self.lr_scheduler = CosineAnnealingWarmupRestarts(
             self.optimizer,
@@ -50,10 +95,49 @@ class TrainRWRDiffusionAgent(TrainAgent):
         # Updates
         self.update_epochs = cfg.train.update_epochs
 
+        # Results are appended as a stream of pickled dicts, one per itr, instead of re-pickling the full list to result.pkl; load by calling pickle.load until EOFError
+        self.result_records_path = os.path.join(self.logdir, "result_records.pkl")
+
+        # Mixed precision for the loss - bf16 if supported, otherwise fp16 with loss scaling
+        self.use_amp = cfg.train.get("use_amp", False) and "cuda" in str(self.device)
+        self.amp_dtype = (
+            torch.bfloat16
+            if self.use_amp and torch.cuda.is_bf16_supported()
+            else torch.float16
+        )
+        self.scaler = torch.amp.GradScaler(
+            "cuda", enabled=self.use_amp and self.amp_dtype == torch.float16
+        )
+
+        # Optionally compile the sampler and the reward weighting - rollout input shape is fixed (n_envs x cond_steps x obs_dim), so CUDA graphs can be captured after warmup
+        self.torch_compile = cfg.train.get("torch_compile", False)
+        self.sample_fn = (
+            torch.compile(self.model, mode="reduce-overhead")
+            if self.torch_compile
+            else self.model
+        )
+        self.reward_weight_fn = (
+            torch.compile(rwr_weights) if self.torch_compile else rwr_weights
+        )
+
+        # Pinned host buffers for rollout obs/samples so device transfers can be async
+        self.use_pinned_memory = torch.cuda.is_available() and "cuda" in str(
+            self.device
+        )
+        if self.use_pinned_memory:
+            self.obs_pinned = torch.empty(
+                (self.n_envs, self.n_cond_step, self.obs_dim), pin_memory=True
+            )
+            self.samples_pinned = torch.empty(
+                (self.n_envs, self.horizon_steps, self.action_dim), pin_memory=True
+            )
+
     def run(self):
         # Start training loop
         timer = Timer()
         run_results = []
+        n_results_saved = 0
+        open(self.result_records_path, "wb").close()  # start a fresh record stream
         cnt_train_step = 0
         last_itr_eval = False
         done_venv = np.zeros((1, self.n_envs))
@@ -80,21 +164,25 @@ class TrainRWRDiffusionAgent(TrainAgent):
                 # if done at the end of last iteration, the envs are just reset
                 firsts_trajs[0] = done_venv
 
-            # Holder
-            obs_trajs = {
-                "state": np.zeros(
-                    (self.n_steps, self.n_envs, self.n_cond_step, self.obs_dim)
-                )
-            }
-            samples_trajs = np.zeros(
-                (
-                    self.n_steps,
-                    self.n_envs,
-                    self.horizon_steps,
-                    self.action_dim,
+            # Holder - every step is written in the loop below, so no need to zero. Obs and samples stay on device so the update does not need to transfer them again, and are only needed for training
+            collect_for_train = not eval_mode
+            if collect_for_train:
+                obs_trajs = {
+                    "state": torch.empty(
+                        (self.n_steps, self.n_envs, self.n_cond_step, self.obs_dim),
+                        device=self.device,
+                    )
+                }
+                samples_trajs = torch.empty(
+                    (
+                        self.n_steps,
+                        self.n_envs,
+                        self.horizon_steps,
+                        self.action_dim,
+                    ),
+                    device=self.device,
                 )
-            )
-            reward_trajs = np.zeros((self.n_steps, self.n_envs))
+            reward_trajs = np.empty((self.n_steps, self.n_envs), dtype=np.float32)
 
             # Collect a set of trajectories from env
             for step in range(self.n_steps):
@@ -102,22 +190,32 @@ class TrainRWRDiffusionAgent(TrainAgent):
                     print(f"Processed step {step} of {self.n_steps}")
 
                 # Select action
-                with torch.no_grad():
-                    cond = {
-                        "state": torch.from_numpy(prev_obs_venv["state"])
-                        .float()
-                        .to(self.device)
-                    }
-                    samples = (
-                        self.model(
-                            cond=cond,
-                            deterministic=eval_mode,
-                        )
-                        .cpu()
-                        .numpy()
-                    )  # n_env x horizon x act
+                with torch.inference_mode():
+                    if self.use_pinned_memory:
+                        self.obs_pinned.copy_(torch.from_numpy(prev_obs_venv["state"]))
+                        cond = {
+                            "state": self.obs_pinned.to(self.device, non_blocking=True)
+                        }
+                    else:
+                        cond = {
+                            "state": torch.from_numpy(prev_obs_venv["state"])
+                            .float()
+                            .to(self.device)
+                        }
+                    samples_device = self.sample_fn(
+                        cond=cond,
+                        deterministic=eval_mode,
+                    )
+                    if self.use_pinned_memory:
+                        self.samples_pinned.copy_(samples_device, non_blocking=True)
+                        torch.cuda.synchronize(self.device)  # single sync per step
+                        samples = self.samples_pinned.numpy()  # n_env x horizon x act
+                    else:
+                        samples = samples_device.cpu().numpy()  # n_env x horizon x act
                 action_venv = samples[:, : self.act_steps]
-                samples_trajs[step] = samples
+                if collect_for_train:
+                    obs_trajs["state"][step] = cond["state"]
+                    samples_trajs[step] = samples_device
 
                 # Apply multi-step action
                 obs_venv, reward_venv, terminated_venv, truncated_venv, info_venv = (
@@ -126,7 +224,6 @@ class TrainRWRDiffusionAgent(TrainAgent):
                 done_venv = terminated_venv | truncated_venv
 
                 # save
-                obs_trajs["state"][step] = prev_obs_venv["state"]
                 reward_trajs[step] = reward_venv
                 firsts_trajs[step + 1] = done_venv
 
@@ -137,56 +234,43 @@ class TrainRWRDiffusionAgent(TrainAgent):
                 cnt_train_step += self.n_envs * self.act_steps if not eval_mode else 0
 
             # Summarize episode reward --- this needs to be handled differently depending on whether the environment is reset after each iteration. Only count episodes that finish within the iteration.
-            episodes_start_end = []
-            for env_ind in range(self.n_envs):
-                env_steps = np.where(firsts_trajs[:, env_ind] == 1)[0]
-                for i in range(len(env_steps) - 1):
-                    start = env_steps[i]
-                    end = env_steps[i + 1]
-                    if end - start > 1:
-                        episodes_start_end.append((env_ind, start, end - 1))
+            episodes_start_end = get_episodes_start_end(firsts_trajs)
             if len(episodes_start_end) > 0:
-                # Compute transitions for completed trajectories
-                obs_trajs_split = [
-                    {"state": obs_trajs["state"][start : end + 1, env_ind]}
-                    for env_ind, start, end in episodes_start_end
-                ]
-                samples_trajs_split = [
-                    samples_trajs[start : end + 1, env_ind]
-                    for env_ind, start, end in episodes_start_end
-                ]
-                reward_trajs_split = [
-                    reward_trajs[start : end + 1, env_ind]
-                    for env_ind, start, end in episodes_start_end
-                ]
-                num_episode_finished = len(reward_trajs_split)
+                # Flatten rewards of completed episodes, with offsets marking where each episode starts
+                episode_lens = np.array(
+                    [end - start + 1 for _, start, end in episodes_start_end]
+                )
+                episode_offsets = np.concatenate(([0], np.cumsum(episode_lens)[:-1]))
+                reward_trajs_flat = np.concatenate(
+                    [
+                        reward_trajs[start : end + 1, env_ind]
+                        for env_ind, start, end in episodes_start_end
+                    ]
+                )
+                reward_trajs_split = np.split(reward_trajs_flat, episode_offsets[1:])
+                num_episode_finished = len(episode_lens)
 
-                # Compute episode returns
+                # Compute episode returns: discount rewards by gamma^t, reverse
+                # cumsum, then divide by gamma^t so that each return is discounted
+                # from its own step
                 returns_trajs_split = [
-                    np.zeros_like(reward_trajs) for reward_trajs in reward_trajs_split
+                    np.cumsum(
+                        (traj_rewards * self.gamma_pows[: len(traj_rewards)])[::-1]
+                    )[::-1]
+                    / self.gamma_pows[: len(traj_rewards)]
+                    for traj_rewards in reward_trajs_split
                 ]
-                for traj_rewards, traj_returns in zip(
-                    reward_trajs_split, returns_trajs_split
-                ):
-                    prev_return = 0
-                    for t in range(len(traj_rewards)):
-                        traj_returns[-t - 1] = (
-                            traj_rewards[-t - 1] + self.gamma * prev_return
-                        )
-                        prev_return = traj_returns[-t - 1]
 
                 # Note: concatenation is okay here since we are concatenating
                 # states and actions later on, in the same order
-                returns_trajs_split = np.concatenate(returns_trajs_split)
-
-                episode_reward = np.array(
-                    [np.sum(reward_traj) for reward_traj in reward_trajs_split]
+                returns_trajs_split = np.concatenate(returns_trajs_split).astype(
+                    np.float32
                 )
-                episode_best_reward = np.array(
-                    [
-                        np.max(reward_traj) / self.act_steps
-                        for reward_traj in reward_trajs_split
-                    ]
+
+                episode_reward = np.add.reduceat(reward_trajs_flat, episode_offsets)
+                episode_best_reward = (
+                    np.maximum.reduceat(reward_trajs_flat, episode_offsets)
+                    / self.act_steps
                 )
                 avg_episode_reward = np.mean(episode_reward)
                 avg_best_reward = np.mean(episode_best_reward)
@@ -201,66 +285,72 @@ class TrainRWRDiffusionAgent(TrainAgent):
                 success_rate = 0
                 log.info("[WARNING] No episode completed within the iteration!")
 
-            # Update models
-            if not eval_mode:
-                # Tensorize data and put them to device
+            # Update models - skipped if no episode completed, since there is no data to train on
+            loss = np.nan
+            if not eval_mode and num_episode_finished > 0:
+                # Compute transitions for completed trajectories
+                obs_trajs_split = [
+                    {"state": obs_trajs["state"][start : end + 1, env_ind]}
+                    for env_ind, start, end in episodes_start_end
+                ]
+                samples_trajs_split = [
+                    samples_trajs[start : end + 1, env_ind]
+                    for env_ind, start, end in episodes_start_end
+                ]
+
+                # Gather data of completed episodes, already on device
                 # k for environment step
                 obs_k = {
-                    "state": torch.tensor(
-                        np.concatenate(
-                            [obs_traj["state"] for obs_traj in obs_trajs_split]
-                        )
+                    "state": torch.cat(
+                        [obs_traj["state"] for obs_traj in obs_trajs_split]
                     )
-                    .float()
-                    .to(self.device)
                 }
-                samples_k = (
-                    torch.tensor(np.concatenate(samples_trajs_split))
-                    .float()
-                    .to(self.device)
+                samples_k = torch.cat(samples_trajs_split)
+
+                # Normalize reward and compute weights
+                rewards_k = torch.from_numpy(returns_trajs_split).to(
+                    self.device, non_blocking=True
+                )  # already float32 and flat
+                rewards_k_scaled = self.reward_weight_fn(
+                    rewards_k, self.beta, self.max_reward_weight
                 )
 
-                # Normalize reward
-                returns_trajs_split = (
-                    returns_trajs_split - np.mean(returns_trajs_split)
-                ) / (returns_trajs_split.std() + 1e-3)
-                rewards_k = (
-                    torch.tensor(returns_trajs_split)
-                    .float()
-                    .to(self.device)
-                    .reshape(-1)
-                )
-                rewards_k_scaled = torch.exp(self.beta * rewards_k)
-                rewards_k_scaled.clamp_(max=self.max_reward_weight)
-
                 # Update policy and critic
                 total_steps = len(rewards_k_scaled)
-                inds_k = np.arange(total_steps)
                 for _ in range(self.update_epochs):
-                    # for each epoch, go through all data in batches
-                    np.random.shuffle(inds_k)
+                    # for each epoch, go through all data in batches; shuffle on device once per epoch so that batches are contiguous slices (views)
+                    inds_k = torch.randperm(total_steps, device=self.device)
+                    obs_k_perm = obs_k["state"].index_select(0, inds_k)
+                    samples_k_perm = samples_k.index_select(0, inds_k)
+                    rewards_k_perm = rewards_k_scaled.index_select(0, inds_k)
                     num_batch = max(1, total_steps // self.batch_size)  # skip last ones
                     for batch in range(num_batch):
                         start = batch * self.batch_size
                         end = start + self.batch_size
-                        inds_b = inds_k[start:end]  # b for batch
-                        obs_b = {"state": obs_k["state"][inds_b]}
-                        samples_b = samples_k[inds_b]
-                        rewards_b = rewards_k_scaled[inds_b]
+                        obs_b = {"state": obs_k_perm[start:end]}  # b for batch
+                        samples_b = samples_k_perm[start:end]
+                        rewards_b = rewards_k_perm[start:end]
 
                         # Update policy with collected trajectories
-                        loss = self.model.loss(
-                            samples_b,
-                            obs_b,
-                            rewards_b,
-                        )
-                        self.optimizer.zero_grad()
-                        loss.backward()
+                        with torch.autocast(
+                            "cuda", dtype=self.amp_dtype, enabled=self.use_amp
+                        ):
+                            loss = self.model.loss(
+                                samples_b,
+                                obs_b,
+                                rewards_b,
+                            )
+                        self.optimizer.zero_grad(set_to_none=True)
+                        self.scaler.scale(loss).backward()
                         if self.max_grad_norm is not None:
+                            self.scaler.unscale_(self.optimizer)
                             torch.nn.utils.clip_grad_norm_(
-                                self.model.parameters(), self.max_grad_norm
+                                self.model.parameters(),
+                                self.max_grad_norm,
+                                foreach=self.on_cuda,
                             )
-                        self.optimizer.step()
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
 
             # Update lr
             self.lr_scheduler.step()
@@ -313,6 +403,9 @@ class TrainRWRDiffusionAgent(TrainAgent):
                             commit=True,
                         )
                     run_results[-1]["train_episode_reward"] = avg_episode_reward
-                with open(self.result_path, "wb") as f:
-                    pickle.dump(run_results, f)
+                # append only the new records
+                with open(self.result_records_path, "ab") as f:
+                    for result in run_results[n_results_saved:]:
+                        pickle.dump(result, f)
+                n_results_saved = len(run_results)
             self.itr += 1